@@ -1,20 +1,223 @@
 # This script uses libraries (see the import statements below)
 #   If you have trouble, you might need to run the following commands in
 #   a command window to install the packages
-#       pip install python-docx
+#       pip install lxml
+#       pip install numpy
 #       pip install pandas
 #       pip install tk
 
 
-from docx import Document
+from lxml import etree
+import zipfile
 import re
 import os
 import sys
+import numpy as np
 import pandas as pd
 import tkinter as tk
 from tkinter import filedialog
 import ast
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+_PAGE_RE = re.compile(r'\[([pP]age )(\d+-*\w*)\]')  # [page ##] markers
+_STOP_RE = re.compile(r'\[page stop\]', re.IGNORECASE)  # [page stop] markers
+_MARKER_RE = re.compile(r"(?P<page>\[[pP]age \d+-*\w*\])"  # [page ##] markers
+                        r"|(?P<correct>\[\[\w+\]\])"  # 'nake [[snake]] corrections
+                        r"|(?P<name>\[[a-zA-Z']+ name\])")  # de-identified names, e.g. [child's name]
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'  # WordprocessingML namespace
+_REGEX_CHARS = set('.^$*+?{}[]\\|()')  # characters that make a key word query a regular expression
+
+_CLASS_PATTERN = r"\[\^?(?:\\[wWsSdD]|[^\]\\\[])+\]"  # a single character class, e.g. [^\w] or [^:]
+_SIMPLE_QUERY_RE = re.compile(r"(?:{0})?([^.^$*+?{{}}\[\]\\|()]+)(?:{0})?".format(_CLASS_PATTERN))  # e.g. [^\w]mad[^\w], child[^:]
+
+def _requiredLiteral(query):
+    r"""
+    Finds the plain text that every match of a simple regular expression
+    query must contain: a word with at most one character class on either
+    side, like the queries in the key words file
+    
+    Parameters
+    ----------
+        query : str
+            Regular expression key word query
+            
+    Returns
+    -------
+        str or None
+            The required text, or None for any other kind of query
+            
+    Examples
+    --------
+    >>> _requiredLiteral(r'[^\w]anger[^\w]')
+    'anger'
+    >>> _requiredLiteral('child[^:]')
+    'child'
+    >>> _requiredLiteral(r"[^\w]she's[^\w]")
+    "she's"
+    >>> _requiredLiteral(r'a\x61b') is None
+    True
+    >>> _requiredLiteral('colou?r') is None
+    True
+    >>> _requiredLiteral('[]a]bc') is None
+    True
+    """
+    match = _SIMPLE_QUERY_RE.fullmatch(query)
+    return match[1] if match else None
+
+def _mainPartName(z):
+    """
+    Name of the main document part in an open .docx zip, found through the
+    officeDocument relationship in _rels/.rels as python-docx does. This is
+    usually, but not always, word/document.xml
+    """
+    for rel in etree.fromstring(z.read('_rels/.rels')):
+        if rel.get('Type', '').endswith('/relationships/officeDocument'):
+            return rel.get('Target').lstrip('/')
+    raise ValueError("No main document part found in {}".format(z.filename))
+
+def _runText(run):
+    """
+    Text of a <w:r> run, following the same rules as python-docx's Run.text
+    """
+    text = ''
+    for child in run:
+        if child.tag == _W + 't':
+            text += child.text or ''
+        elif child.tag in (_W + 'tab', _W + 'ptab'):
+            text += '\t'
+        elif child.tag == _W + 'br':
+            text += '\n' if child.get(_W + 'type', 'textWrapping') == 'textWrapping' else ''
+        elif child.tag == _W + 'cr':
+            text += '\n'
+        elif child.tag == _W + 'noBreakHyphen':
+            text += '-'
+    return text
+
+def _paragraphTexts(filename):
+    """
+    Streams the text of each top level paragraph in a .docx file straight
+    from its XML, without building the python-docx object model
+    
+    Parameters
+    ----------
+        filename : str
+            Path to a .docx file
+            
+    Yields
+    ------
+        str
+            Text of each paragraph, in document order
+    """
+    with zipfile.ZipFile(filename) as z, z.open(_mainPartName(z)) as f:
+        for event, elem in etree.iterparse(f, events=('end',), tag=_W + 'p'):
+            body = elem.getparent()
+            if body.tag != _W + 'body':
+                continue  # paragraphs inside tables, text boxes, etc.
+            text = ''
+            for child in elem:
+                if child.tag == _W + 'r':
+                    text += _runText(child)
+                elif child.tag == _W + 'hyperlink':
+                    text += ''.join(_runText(run) for run in child.iterchildren(_W + 'r'))
+            yield text
+            # Free the paragraphs (and tables) that have already been read
+            elem.clear()
+            while elem.getprevious() is not None:
+                del body[0]
+
+def _pageRecords(filename, verbose=True):
+    """
+    Iterates through a .docx file and collects data for each page number.
+    Kept at module level so it can run in a worker process
+    
+    Parameters
+    ----------
+        filename : str
+            Path to a .docx file
+            
+        verbose : bool, optional
+            Whether to print out helpful statements to show progress; default is True
+            
+    Returns
+    -------
+        dict
+            Maps each page index (e.g. 'Child1-Page-3') to a dict of that page's data
+    """
+    currDoc = filename.split(os.sep)[-1][:-5]
+    if verbose:
+        print('Working to analyze ' + currDoc)  # User-friendly message
+    records = {}
+    currIndex = None
+    currPage = None
+    currSpeaker = None
+    for text in _paragraphTexts(filename):
+        if text == '':
+            continue
+
+        # Update from a speaker change
+        if text[:5].lower() in ['paren', 'child']:
+            prevSpeaker = currSpeaker
+            currSpeaker = text[:5].lower()
+            speakerChange = prevSpeaker is not None and prevSpeaker != currSpeaker
+
+        # Skip everything on a stop page until the next [page ##]
+        if _STOP_RE.search(text):
+            if verbose:
+                print('Stop Page Detected')
+            currIndex = None
+            continue
+
+        # Update from a page change
+        page_in_para = _PAGE_RE.search(text)
+        if page_in_para:
+            currPage = page_in_para[2]
+            currIndex = currDoc + '-Page-' + currPage
+            record = records.get(currIndex)
+            if record is None:
+                firstSpeaker = 'parent' if currSpeaker == 'paren' else 'child'
+                speakerChange = False
+                record = {'ID': currDoc,
+                          'PageNum': currPage,
+                          'first_speaker': firstSpeaker,
+                          'first_text': text,
+                          'P_transcript': [],
+                          'C_transcript': [],
+                          'full_transcript': [],
+                          'num_parent_initial_questions': 0, #initialize to 0
+                          'P_WordCount': 0,
+                          'C_WordCount': 0}
+                records[currIndex] = record
+            else:
+                speakerChange = True
+
+        if currIndex is not None:
+            # Save the transcript
+            if currSpeaker == 'paren':
+                record['P_transcript'].append(' ' + text)
+            elif currSpeaker == 'child':
+                record['C_transcript'].append(' ' + text)
+            record['full_transcript'].append(' ' + text + '\n')
+                
+            # Update num_parent_questions
+            question_count = text.count('?')
+            question_count = question_count if firstSpeaker=='parent' and not speakerChange else 0
+            record['num_parent_initial_questions'] += question_count
+
+            # Update the Word Count
+            wordcount = len(text.split())  # Count the total number of words
+            markers = {'page': 0, 'correct': 0, 'name': 0}
+            for match in _MARKER_RE.finditer(text):  # Find the [page ##], [[corrected]] and [child's name] markers in one pass
+                markers[match.lastgroup] += 1
+            pageNum = markers['page']
+            wordCorrect = markers['correct']
+            name = markers['name']
+            words = wordcount - 2*pageNum - wordCorrect - name  # Each [page ##] has two words, each [[corrected]] has one, and count [child's name] as 1 word instead of two
+            if (currSpeaker == 'paren'):
+                record['P_WordCount'] += words
+            elif (currSpeaker == 'child'):
+                record['C_WordCount'] += words
+    return records
 
 class Socialization_of_Emotion(object):
     """
@@ -94,107 +297,35 @@ class Socialization_of_Emotion(object):
             self._setUp()            
         
     def _setUp(self):
-        directory = os.fsencode(self.originDirectory)
-        columnNames = ['ID', 'PageNum', 'first_speaker', 'first_text', 'P_transcript', 
-                       'C_transcript', 'full_transcript', 'num_parent_initial_questions', 'P_WordCount',
-                       'C_WordCount']
-        self.df_counts = pd.DataFrame(columns=columnNames)
-        for file in os.listdir(directory):  # Grab each file, one at a time
-            filename = os.fsdecode(file)  # Take the code from computer language to a path
-            if filename.split('.')[-1] != 'docx':
-                continue #skip non .docx files
-            openName = self.originDirectory + os.sep + filename # I want to leave the original files alone, so put edited files in a different location
-            self._updateWordCount(openName)
-            self.setUpFile = self.saveDirectory + os.sep + self.saveFile
-            self.df_counts.to_csv(self.setUpFile, index=True, index_label='Participant_ID')
-        
-    def _updateWordCount(self, filename):
+        with os.scandir(self.originDirectory) as entries:  # Grab each .docx file, skipping everything else
+            openNames = [entry.path for entry in entries if entry.is_file() and entry.name.lower().endswith('.docx')]
+        pageRecords = {}
+        with ProcessPoolExecutor() as executor:  # Each file is independent, so read them in parallel
+            for records in executor.map(_pageRecords, openNames, [self.verbose] * len(openNames)):
+                pageRecords.update(records)
+        self._buildCounts(pageRecords)
+        self.setUpFile = self.saveDirectory + os.sep + self.saveFile
+        self.df_counts.to_csv(self.setUpFile, index=True, index_label='Participant_ID')
+
+    def _buildCounts(self, pageRecords):
         """
-        Iterates through a .docx file and adds data for each page number
+        Builds self.df_counts from per-page records
         
         Parameters
         ----------
-            filename : str
-                Path to a .docx file
+            pageRecords : dict
+                Maps each page index to that page's data, as returned by _pageRecords
         """
-        currDoc = filename.split(os.sep)[-1][:-5]
-        if self.verbose:
-            print('Working to analyze ' + currDoc)  # User-friendly message
-        currIndex = None
-        currPage = None
-        currSpeaker = None
-        doc = Document(filename)  # Open the current document
-        prev_paragraph = None
-        for paragraph in doc.paragraphs:
-            if paragraph.text == '':
-                continue
-
-            # Update from a speaker change
-            if paragraph.text[:5].lower() in ['paren', 'child']:
-                prevSpeaker = currSpeaker
-                currSpeaker = paragraph.text[:5].lower()
-                speakerChange = prevSpeaker is not None and prevSpeaker != currSpeaker
-
-            # Update from a page change
-            page_in_para = re.search('\[([pP]age )(\d+-*\w*)\]', paragraph.text)
-            if page_in_para:
-                currPage = page_in_para[2]
-                currIndex = currDoc + '-Page-' + currPage
-                if (currPage.lower == 'stop'):
-                    if self.verbose:
-                        print('Stop Page Detected')
-                else:
-                    self.df_counts.loc[currIndex, 'ID'] = currDoc
-                    self.df_counts.loc[currIndex, 'PageNum'] = currPage
-                    if pd.isna(self.df_counts.loc[currIndex, 'first_speaker']):
-                        firstSpeaker = 'parent' if currSpeaker == 'paren' else 'child'
-                        speakerChange = False
-                        self.df_counts.loc[currIndex, 'first_speaker'] = firstSpeaker
-                        self.df_counts.loc[currIndex, 'first_text'] = paragraph.text
-                        self.df_counts.loc[currIndex, 'num_parent_initial_questions'] = 0 #initialize to 0
-                    else:
-                        speakerChange = True
-
-            if currIndex is not None:
-                # Save the transcript
-                if currSpeaker == 'paren':
-                    if pd.isna(self.df_counts.loc[currIndex, 'P_transcript']):
-                        self.df_counts.loc[currIndex, 'P_transcript'] = ""
-                    self.df_counts.loc[currIndex, 'P_transcript'] += ' ' + paragraph.text
-                elif currSpeaker == 'child':
-                    if pd.isna(self.df_counts.loc[currIndex, 'C_transcript']):
-                        self.df_counts.loc[currIndex, 'C_transcript'] = ""
-                    self.df_counts.loc[currIndex, 'C_transcript'] += ' ' + paragraph.text
-
-                if pd.isna(self.df_counts.loc[currIndex, 'full_transcript']):
-                    self.df_counts.loc[currIndex, 'full_transcript'] = ""
-                self.df_counts.loc[currIndex, 'full_transcript'] += ' ' + paragraph.text + '\n'
-
-                # Handle the initialization of a new cell
-                if pd.isna(self.df_counts.loc[currIndex, 'P_WordCount']):
-                    self.df_counts.loc[currIndex, 'P_WordCount'] = 0
-                if pd.isna(self.df_counts.loc[currIndex, 'C_WordCount']):
-                    self.df_counts.loc[currIndex, 'C_WordCount'] = 0
-                    
-                # Update num_parent_questions
-                question_count = len(re.findall("\\?", paragraph.text))
-                question_count = question_count if firstSpeaker=='parent' and not speakerChange else 0
-                self.df_counts.loc[currIndex, 'num_parent_initial_questions'] += question_count
-
-                # Update the Word Count
-                wordcount = len(re.findall("(\S+)", paragraph.text))  # Count the total number of words
-                pageNum = len(re.findall(r'\[([pP]age )(\d+-*\w*)\]',
-                                         paragraph.text))  # Find all the [page ##] to subtract from word count
-                wordCorrect = len(re.findall(r'\[\[\w+\]\]',
-                                             paragraph.text))  # Find all the instances of 'nake [[snake]] where word is corrected
-                name = len(re.findall(r'\[[a-zA-Z\']+ name\]',
-                                      paragraph.text))  # Find the instances where name has been de-identified
-                words = wordcount - 2*pageNum - wordCorrect - name  # Each [page ##] has two words, each [[corrected]] has one, and count [child's name] as 1 word instead of two
-                if (currSpeaker == 'paren'):
-                    self.df_counts.loc[currIndex, 'P_WordCount'] += words
-                elif (currSpeaker == 'child'):
-                    self.df_counts.loc[currIndex, 'C_WordCount'] += words
-                    
+        columnNames = ['ID', 'PageNum', 'first_speaker', 'first_text', 'P_transcript', 
+                       'C_transcript', 'full_transcript', 'num_parent_initial_questions', 'P_WordCount',
+                       'C_WordCount']
+        df = pd.DataFrame.from_dict(pageRecords, orient='index', columns=columnNames)
+        for col in ['P_transcript', 'C_transcript', 'full_transcript']:
+            df[col] = df[col].map(lambda fragments: ''.join(fragments) if fragments else None)
+        for col in ['ID', 'PageNum']:
+            df[col] = df[col].astype('category')  # few distinct values, repeated on every page
+        self.df_counts = df
+        
     def search_keys(self):
         """
         Iterates over keysFile and searches each transcript for a match. 
@@ -208,12 +339,26 @@ class Socialization_of_Emotion(object):
         keywords = pd.read_csv(self.keysFile)
         if self.verbose:
             print('Analyzing Key Words')
-        for index, row in keywords.iterrows():
-            for query in row:
-                if isinstance(query, str):
-                    self.df_counts.loc[:, 'P_' + query] = self.df_counts.P_transcript.str.lower().str.count(query)
-                    self.df_counts.loc[:, 'C_' + query] = self.df_counts.C_transcript.str.lower().str.count(query)
-        self.df_counts.fillna(0, inplace=True)
+        P_lower = self.df_counts.P_transcript.fillna('').str.lower().tolist()
+        C_lower = self.df_counts.C_transcript.fillna('').str.lower().tolist()
+        queries = [query for query in keywords.to_numpy().ravel().tolist() if isinstance(query, str)]  # row by row, skipping empty cells
+        queries = list(dict.fromkeys(queries))  # scan repeated key words only once, keeping the first position
+        keyCounts = {}
+        for query in queries:
+            if _REGEX_CHARS.isdisjoint(query):
+                # Plain words can use str.count, which gives the same non-overlapping count
+                keyCounts['P_' + query] = [text.count(query) for text in P_lower]
+                keyCounts['C_' + query] = [text.count(query) for text in C_lower]
+            else:
+                pattern = re.compile(query)  # e.g. [^\w]mad[^\w]
+                literal = _requiredLiteral(query) or ''  # only run the regex on transcripts that could match
+                keyCounts['P_' + query] = [len(pattern.findall(text)) if literal in text else 0 for text in P_lower]
+                keyCounts['C_' + query] = [len(pattern.findall(text)) if literal in text else 0 for text in C_lower]
+        # One int32 block for all of the key word columns
+        counts = np.array(list(keyCounts.values()), dtype=np.int32).reshape(len(keyCounts), len(self.df_counts)).T
+        self.df_counts = pd.concat([self.df_counts.drop(columns=list(keyCounts), errors='ignore'),
+                                    pd.DataFrame(counts, index=self.df_counts.index, columns=list(keyCounts))], axis=1)
+        self.df_counts.fillna({col: 0 for col in self.df_counts.select_dtypes(exclude='category').columns}, inplace=True)
         savePath = self.saveDirectory + os.sep + self.saveFile
         self.df_counts.to_csv(savePath, index=True, index_label='Participant_ID')
         if self.verbose: